@@ -0,0 +1,152 @@
+# Benchmark of bytes on the wire and encode time for search responses
+#
+# Usage: python benchmark_serialization.py [--results 10] [--iterations 500]
+# Encoders or codings whose package is not installed are skipped.
+import argparse
+import hashlib
+import time
+
+import serialization
+
+# Distinct, realistic text so compression is not flattered by repeated strings
+CASE_TITLES = [
+    "Maneka_Gandhi_v_Union_of_India_1978",
+    "Kesavananda_Bharati_v_State_of_Kerala_1973",
+    "Justice_KS_Puttaswamy_v_Union_of_India_2017",
+    "Olga_Tellis_v_Bombay_Municipal_Corporation_1985",
+    "Vishaka_v_State_of_Rajasthan_1997",
+    "Hussainara_Khatoon_v_Home_Secretary_Bihar_1979",
+    "Francis_Coralie_Mullin_v_Administrator_Delhi_1981",
+    "Navtej_Singh_Johar_v_Union_of_India_2018",
+    "Shreya_Singhal_v_Union_of_India_2015",
+    "DK_Basu_v_State_of_West_Bengal_1996",
+    "Bandhua_Mukti_Morcha_v_Union_of_India_1984",
+    "Common_Cause_v_Union_of_India_2018",
+]
+SNIPPET_SENTENCES = [
+    "The procedure prescribed by law for depriving a person of personal liberty must be <b>fair, just and reasonable</b>, not fanciful or oppressive.",
+    "Articles 14, 19 and 21 are not mutually exclusive; a law depriving liberty must satisfy the tests of all three.",
+    "The passport authority cannot impound a document without giving the holder an opportunity to be heard.",
+    "Parliament may amend any provision of the Constitution but cannot alter its <b>basic structure</b>.",
+    "Judicial review, federalism and secularism were identified as part of the basic features beyond amending power.",
+    "The majority of seven judges limited the scope of Article 368 while upholding the Twenty-fourth Amendment.",
+    "Privacy is protected as an intrinsic part of the <b>right to life and personal liberty</b> under Article 21.",
+    "Any intrusion into privacy must satisfy legality, a legitimate aim and proportionality.",
+    "Informational privacy requires the State to put in place a robust regime for data protection.",
+    "The right to livelihood is included in the right to life because no person can live without the means of living.",
+    "Pavement dwellers may not be evicted without notice and a reasonable opportunity to show cause.",
+    "The Municipal Commissioner's discretion under section 314 must be exercised reasonably.",
+    "In the absence of legislation, the guidelines on sexual harassment at the workplace shall be treated as the law declared under Article 141.",
+    "Employers must constitute a complaints committee headed by a woman with at least half of its members women.",
+    "International conventions consistent with fundamental rights may be read into their content.",
+    "A <b>speedy trial</b> is an essential ingredient of reasonable, fair and just procedure under Article 21.",
+    "Undertrial prisoners who have been in custody longer than the maximum sentence must be released forthwith.",
+    "The State cannot deny a speedy trial on the ground of financial or administrative inability.",
+    "The right to life includes the right to live with human dignity and the bare necessaries of life.",
+    "A detenu is entitled to interview a legal adviser and to meet family members under reasonable conditions.",
+    "Prison regulations restricting interviews must be tested against Articles 14 and 21.",
+    "Section 377 of the Indian Penal Code is unconstitutional in so far as it criminalises consensual adult conduct.",
+    "Sexual orientation is an essential attribute of privacy and its protection lies at the core of Articles 14, 15 and 21.",
+    "Constitutional morality cannot be martyred at the altar of social morality.",
+    "Section 66A of the Information Technology Act is struck down as vague and over-broad.",
+    "Discussion and advocacy, however unpopular, are at the heart of the <b>freedom of speech</b> under Article 19(1)(a).",
+    "Intermediaries need only act on actual knowledge from a court order or government notification.",
+    "Arrest and detention must be recorded in a memo attested by at least one witness and countersigned by the arrestee.",
+    "Custodial violence is a calculated assault on human dignity and the State is liable to pay compensation.",
+    "The arrestee shall be medically examined every forty-eight hours during detention.",
+    "Bonded labourers must be identified, released and rehabilitated by the State under the Bonded Labour System Act.",
+    "A letter addressed to the Court may be treated as a writ petition in public interest litigation.",
+    "The right to die with dignity is part of Article 21, and advance directives are permissible subject to safeguards.",
+    "Passive euthanasia may be carried out on the opinion of two medical boards and approval of the magistrate.",
+    "Withdrawal of life support must follow the procedure laid down until Parliament enacts a law.",
+    "The State must ensure the dignity of the individual is preserved even at the end of life.",
+]
+SUMMARY_SENTENCES = [
+    "Article 21 guarantees that no person shall be deprived of life or personal liberty except according to procedure established by law [1].",
+    "Since Maneka Gandhi, that procedure must be fair, just and reasonable, and must also satisfy Articles 14 and 19 [1][2].",
+    "The Supreme Court has read the guarantee to include privacy, which is subject to a proportionality test [3].",
+    "It also covers the right to livelihood, so pavement dwellers cannot be evicted without a hearing [4].",
+    "Undertrial prisoners have a right to a speedy trial, and detenus may meet lawyers and family [6][7].",
+    "Protection against custodial violence and the right to die with dignity have likewise been recognised [10][12].",
+]
+
+def build_payload(result_count: int) -> dict:
+    """
+    Builds a search response shaped like the output of search_data_store,
+    with distinct text for every result.
+    """
+    references = []
+    for i in range(result_count):
+        file_name = f"20250920_1015{i:02d}_{hashlib.md5(str(i).encode('utf-8')).hexdigest()[:8]}_{CASE_TITLES[i % len(CASE_TITLES)]}.pdf"
+        document_id = "doc-" + file_name.lower().replace('.', '-')
+        sentences = [SNIPPET_SENTENCES[(3 * i + j) % len(SNIPPET_SENTENCES)] for j in range(3)]
+        references.append({
+            "document_id": document_id,
+            "title": file_name,
+            "link": f"gs://spastha-final-bucket/{file_name}",
+            "snippet": " ... ".join(sentences),
+        })
+    return {
+        "query": "what does article 21 of the constitution protect",
+        "total_results": 137,
+        "nextPageToken": "eyJvZmZzZXQiOiAxMH0=",
+        "summary": " ".join(SUMMARY_SENTENCES),
+        "references": references,
+    }
+
+def time_call(func, iterations: int):
+    """
+    Returns the result of func and its mean run time in microseconds.
+    """
+    result = func()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return result, (time.perf_counter() - start) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark search response encodings.')
+    parser.add_argument('--results', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    payload = build_payload(args.results)
+
+    # Every measurement goes through the shipped encode_payload/compress_body with the
+    # Accept and Accept-Encoding values a client would send
+    accepts = [("application/json", serialization.orjson)]
+    if serialization.orjson is not None:
+        accepts.append(("application/json", None))  # Standard library fallback
+    if serialization.msgpack is not None:
+        accepts.append(("application/msgpack", serialization.orjson))
+    accept_encodings = ["identity", "gzip"]
+    if serialization.brotli is not None:
+        accept_encodings.append("br")
+
+    print(f"Search response with {args.results} results, {args.iterations} iterations per measurement")
+    print(f"{'encoder':<24}{'coding':<10}{'bytes':>10}{'encode us':>12}{'compress us':>14}{'total us':>12}")
+    installed_orjson = serialization.orjson
+    for accept, orjson_module in accepts:
+        serialization.orjson = orjson_module
+        try:
+            (body, content_type), encode_us = time_call(
+                lambda: serialization.encode_payload(payload, accept), args.iterations
+            )
+        finally:
+            serialization.orjson = installed_orjson
+        if content_type == serialization.JSON_CONTENT_TYPE:
+            encoder_name = "json (orjson)" if orjson_module is not None else "json (stdlib)"
+        else:
+            encoder_name = content_type.split('/')[-1]
+
+        for accept_encoding in accept_encodings:
+            (wire_body, content_encoding), compress_us = time_call(
+                lambda: serialization.compress_body(body, accept_encoding), args.iterations
+            )
+            print(
+                f"{encoder_name:<24}{content_encoding or 'identity':<10}{len(wire_body):>10}"
+                f"{encode_us:>12.1f}{compress_us:>14.1f}{encode_us + compress_us:>12.1f}"
+            )
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,103 @@
 # FUNCTION 2: Search Function
 import functions_framework
+import base64
+import datetime
+import hashlib
+import json
+import math
 import os
+import random
+import re
+import threading
+import time
+from collections import deque
+import jwt
+from flask import Response
 from google.api_core.client_options import ClientOptions
 from google.cloud import discoveryengine_v1 as discoveryengine
+from google.cloud import firestore
+from serialization import compress_body, encode_payload
 
 # --- FINAL CONFIGURATION ---
 PROJECT_ID = "eminent-cycle-472512-u1"
 LOCATION = "global"
 DATA_STORE_ID = "spastha-final-datastore_1758347694410"  # Replace with your actual data store ID
+
+# Answer store (Firestore) used to serve precomputed answers for trending questions
+ANSWER_STORE_COLLECTION = "answer_store"
+QUERY_STATS_COLLECTION = "query_stats"  # Needs a Firestore TTL policy on expire_at
+CORPUS_META_COLLECTION = "answer_store_meta"
+CORPUS_META_DOCUMENT = "corpus"  # Version is bumped by the ingest function
+WARM_TOP_N = 25  # Number of trending queries kept warm
+MAX_WARM_TOP_N = 100
+TRENDING_WINDOW_DAYS = 3  # Query counts older than this do not count towards trending
+TRENDING_CANDIDATES_PER_DAY = 500  # Most asked queries read from each daily bucket
+QUERY_STATS_SAMPLE_EVERY = 10  # Roughly one in this many requests updates the counters
+CORPUS_VERSION_TTL_SECONDS = 60  # How long an instance reuses the corpus version it read
+
+# Pagination and field projection for search results
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 50
+MAX_RESULT_OFFSET = 500  # Deepest result a page token may point at
+REFERENCE_FIELDS = ['document_id', 'title', 'link', 'snippet']
+
+# Request filter keys mapped to the struct_data fields written by the ingest function
+FILTER_FIELDS = {
+    'documentIds': 'document_id',
+    'documentType': 'document_type',
+    'uploadedBy': 'uploaded_by',
+    'caseId': 'case_id',
+}
+MAX_FILTER_VALUES = 50
+
+# Rate limiting. Identities come from JWTs issued by the backend /api/login endpoint.
+JWT_SIGNING_KEY = os.environ.get('JWT_SIGNING_KEY', '')  # Must match the Django SECRET_KEY
+JWT_ALGORITHM = "HS256"
+RATE_LIMIT_COLLECTION = "rate_limits"  # Needs a Firestore TTL policy on expire_at
+USE_SHARED_RATE_LIMIT = os.environ.get('USE_SHARED_RATE_LIMIT', '').lower() == 'true'
+# Proxies that append to X-Forwarded-For: 1 for Google's front end alone,
+# 2 when an external HTTPS load balancer sits in front of the function
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+QUOTA_WINDOW_SECONDS = 3600
+MAX_TRACKED_IDENTITIES = 10000  # Idle, then least recently seen, identities are pruned beyond this many
+PRUNE_TARGET_RATIO = 0.9  # Pruning frees room down to this share of MAX_TRACKED_IDENTITIES
+# rate: tokens refilled per second, burst: bucket size, quota: requests per window
+QUOTA_TIERS = {
+    "anonymous": {"rate": 0.2, "burst": 5, "quota": 30},
+    "student": {"rate": 0.5, "burst": 10, "quota": 150},
+    "law_practitioner": {"rate": 1.0, "burst": 20, "quota": 600},
+    "other": {"rate": 0.5, "burst": 10, "quota": 150},
+}
 # --- END CONFIGURATION ---
 
+_rate_limit_lock = threading.Lock()
+_token_buckets = {}  # identity -> (tokens, last_refill)
+_request_windows = {}  # identity -> deque of request timestamps
+
+_firestore_client = None
+_corpus_version_cache = (0, 0.0)  # (version, time read)
+
+def get_firestore_client():
+    """
+    Returns a Firestore client, reused across invocations of the same instance.
+    """
+    global _firestore_client
+    if _firestore_client is None:
+        _firestore_client = firestore.Client(project=PROJECT_ID)
+    return _firestore_client
+
 @functions_framework.http
 def ask_legal_ai(request):
     """
-    HTTP Cloud Function that queries ALL documents in the data store.
+    HTTP Cloud Function that queries ALL documents in the data store,
+    unless the request body narrows the search with "filters".
     """
     # Handle CORS preflight requests
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
@@ -32,6 +109,16 @@ def ask_legal_ai(request):
         if request.method != 'POST':
             return ({'error': 'Only POST method is allowed.'}, 405, headers)
         
+        identity, tier = get_request_identity(request)
+        retry_after = check_rate_limit(identity, tier)
+        if retry_after is not None:
+            print(f"Rate limit exceeded for {identity} ({tier} tier)")
+            return (
+                {'error': 'Too many requests. Please try again later.'},
+                429,
+                {**headers, 'Retry-After': str(retry_after), 'Access-Control-Expose-Headers': 'Retry-After'}
+            )
+        
         request_json = request.get_json(silent=True)
         
         # Better error handling for missing JSON or query
@@ -47,17 +134,428 @@ def ask_legal_ai(request):
         if len(user_query) > 1000:
             return ({'error': 'Query too long. Maximum 1000 characters allowed.'}, 400, headers)
         
-        search_results = search_data_store(user_query)
-        return (search_results, 200, headers)
+        page_size = request_json.get('pageSize', DEFAULT_PAGE_SIZE)
+        if isinstance(page_size, bool) or not isinstance(page_size, int) or not 1 <= page_size <= MAX_PAGE_SIZE:
+            return ({'error': f'"pageSize" must be an integer between 1 and {MAX_PAGE_SIZE}.'}, 400, headers)
+        
+        page_token = request_json.get('pageToken', '')
+        offset = decode_page_token(page_token)
+        if offset is None:
+            return ({'error': 'Invalid "pageToken" provided.'}, 400, headers)
+        
+        fields = request_json.get('fields', REFERENCE_FIELDS)
+        if not isinstance(fields, list) or not fields or any(field not in REFERENCE_FIELDS for field in fields):
+            return ({'error': f'"fields" must be a non-empty list containing only: {", ".join(REFERENCE_FIELDS)}.'}, 400, headers)
+        
+        filters = request_json.get('filters') or {}
+        if not isinstance(filters, dict):
+            return ({'error': '"filters" must be an object.'}, 400, headers)
+        try:
+            search_filter = build_search_filter(filters)
+        except ValueError as e:
+            return ({'error': str(e)}, 400, headers)
+        
+        include_summary = request_json.get('includeSummary', True)
+        if not isinstance(include_summary, bool):
+            return ({'error': '"includeSummary" must be a boolean.'}, 400, headers)
+        
+        # Unfiltered first pages up to the default size are projections of the stored default answer
+        search_results = None
+        if not page_token and not search_filter and page_size <= DEFAULT_PAGE_SIZE:
+            record_query(user_query)
+            
+            # Serve trending questions straight from the answer store when possible.
+            # The store is only a cache, so searches go ahead when Firestore is unavailable.
+            try:
+                corpus_version = get_corpus_version()
+            except Exception as e:
+                print(f"Could not read corpus version, skipping answer store: {e}")
+                corpus_version = None
+            
+            if corpus_version is not None:
+                search_results = get_stored_answer(user_query, corpus_version)
+            if search_results is None and include_summary:
+                search_results = search_data_store(user_query)
+                if corpus_version is not None:
+                    store_answer(user_query, search_results, corpus_version)
+            if search_results is not None:
+                search_results = project_answer(search_results, page_size, fields, include_summary)
+        
+        if search_results is None:
+            search_results = search_data_store(
+                user_query, page_size=page_size, offset=offset, fields=fields,
+                search_filter=search_filter, include_summary=include_summary
+            )
+        
+        return build_response(request, search_results, 200, headers)
         
     except Exception as e:
         print(f"An error occurred during the search process: {e}")
         return ({'error': 'An internal error occurred while querying the AI service.'}, 500, headers)
 
-def search_data_store(search_query: str) -> dict:
+@functions_framework.http
+def warm_answer_store(request):
     """
-    Calls the Vertex AI Search API across all documents.
+    HTTP Cloud Function (invoked by Cloud Scheduler) that precomputes answers
+    for the queries asked most over the last few days. Answers computed against
+    an older corpus version are refreshed, so newly ingested documents are picked up.
     """
+    try:
+        request_json = request.get_json(silent=True) or {}
+        top_n = request_json.get('topN', WARM_TOP_N)
+        if not isinstance(top_n, int) or not 1 <= top_n <= MAX_WARM_TOP_N:
+            return ({'error': f'"topN" must be an integer between 1 and {MAX_WARM_TOP_N}.'}, 400)
+        
+        db = get_firestore_client()
+        corpus_version = get_corpus_version(max_age=0)
+        
+        warmed, skipped, failed = 0, 0, 0
+        for key, query in get_trending_queries(top_n):
+            stored = db.collection(ANSWER_STORE_COLLECTION).document(key).get()
+            if stored.exists and stored.to_dict().get("corpus_version") == corpus_version:
+                skipped += 1
+                continue
+            
+            try:
+                store_answer(query, search_data_store(query), corpus_version)
+                warmed += 1
+            except Exception as e:
+                print(f"Failed to warm answer for query '{query}': {e}")
+                failed += 1
+        
+        print(f"Answer store warming complete. Warmed: {warmed}, up to date: {skipped}, failed: {failed}")
+        return ({'warmed': warmed, 'upToDate': skipped, 'failed': failed, 'corpusVersion': corpus_version}, 200)
+        
+    except Exception as e:
+        print(f"An error occurred while warming the answer store: {e}")
+        return ({'error': 'An internal error occurred while warming the answer store.'}, 500)
+
+def normalize_query(search_query: str) -> str:
+    """
+    Normalizes a query so trivially different phrasings share one store entry.
+    """
+    return re.sub(r'\s+', ' ', search_query.strip().lower())
+
+def query_key(search_query: str) -> str:
+    """
+    Returns the Firestore document ID used for a query.
+    """
+    return hashlib.sha256(normalize_query(search_query).encode('utf-8')).hexdigest()
+
+def get_corpus_version(max_age: float = CORPUS_VERSION_TTL_SECONDS) -> int:
+    """
+    Returns the current corpus version written by the ingest function.
+    The value is reused for up to max_age seconds to keep Firestore reads off the request path.
+    """
+    global _corpus_version_cache
+    version, read_at = _corpus_version_cache
+    now = time.time()
+    if now - read_at < max_age:
+        return version
+    
+    snapshot = (
+        get_firestore_client()
+        .collection(CORPUS_META_COLLECTION)
+        .document(CORPUS_META_DOCUMENT)
+        .get()
+    )
+    version = snapshot.to_dict().get("version", 0) if snapshot.exists else 0
+    _corpus_version_cache = (version, now)
+    return version
+
+def record_query(search_query: str):
+    """
+    Counts a query in today's bucket. Only a sample of requests writes to Firestore,
+    each adding the sampling factor, so most requests skip the round trip.
+    Failures never block the search.
+    """
+    if random.randrange(QUERY_STATS_SAMPLE_EVERY) != 0:
+        return
+    try:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        day = now.strftime('%Y-%m-%d')
+        key = query_key(search_query)
+        get_firestore_client().collection(QUERY_STATS_COLLECTION).document(f"{day}_{key}").set({
+            "query": normalize_query(search_query),
+            "query_key": key,
+            "day": day,
+            "count": firestore.Increment(QUERY_STATS_SAMPLE_EVERY),
+            # Raw questions are deleted by the TTL policy once they leave the trending window
+            "expire_at": now + datetime.timedelta(days=TRENDING_WINDOW_DAYS + 1),
+        }, merge=True)
+    except Exception as e:
+        print(f"Could not record query statistics: {e}")
+
+def get_trending_queries(top_n: int) -> list:
+    """
+    Returns (query key, query) pairs for the top_n queries by count over the
+    last TRENDING_WINDOW_DAYS daily buckets.
+    """
+    db = get_firestore_client()
+    today = datetime.datetime.now(datetime.timezone.utc)
+    totals, queries = {}, {}
+    for days_ago in range(TRENDING_WINDOW_DAYS):
+        day = (today - datetime.timedelta(days=days_ago)).strftime('%Y-%m-%d')
+        # Needs a composite index on (day, count desc)
+        bucket = (
+            db.collection(QUERY_STATS_COLLECTION)
+            .where(filter=firestore.FieldFilter("day", "==", day))
+            .order_by("count", direction=firestore.Query.DESCENDING)
+            .limit(TRENDING_CANDIDATES_PER_DAY)
+            .stream()
+        )
+        for snapshot in bucket:
+            stats = snapshot.to_dict()
+            key, query = stats.get("query_key"), stats.get("query")
+            if not key or not query:
+                continue
+            totals[key] = totals.get(key, 0) + stats.get("count", 0)
+            queries[key] = query
+    
+    top_keys = sorted(totals, key=totals.get, reverse=True)[:top_n]
+    return [(key, queries[key]) for key in top_keys]
+
+def get_stored_answer(search_query: str, corpus_version: int):
+    """
+    Returns the precomputed answer for a query, or None if it is missing or stale.
+    """
+    try:
+        snapshot = get_firestore_client().collection(ANSWER_STORE_COLLECTION).document(query_key(search_query)).get()
+        if not snapshot.exists:
+            return None
+        
+        entry = snapshot.to_dict()
+        if entry.get("corpus_version") != corpus_version:
+            return None
+        
+        print(f"Serving stored answer for query: {search_query}")
+        response = entry["response"]
+        response["query"] = search_query
+        return response
+    except Exception as e:
+        print(f"Could not read from answer store: {e}")
+        return None
+
+def store_answer(search_query: str, response: dict, corpus_version: int):
+    """
+    Saves a computed answer in the answer store. Failures never block the search.
+    """
+    try:
+        get_firestore_client().collection(ANSWER_STORE_COLLECTION).document(query_key(search_query)).set({
+            "query": normalize_query(search_query),
+            "response": response,
+            "corpus_version": corpus_version,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        })
+    except Exception as e:
+        print(f"Could not write to answer store: {e}")
+
+def project_answer(answer: dict, page_size: int, fields: list, include_summary: bool) -> dict:
+    """
+    Returns the first page_size references of a stored default answer, limited to the requested fields.
+    """
+    references = answer.get("references", [])
+    projected = {
+        "query": answer["query"],
+        "total_results": answer.get("total_results", len(references)),
+        "references": [
+            {field: reference[field] for field in fields if field in reference}
+            for reference in references[:page_size]
+        ],
+        "nextPageToken": encode_page_token(page_size) if len(references) > page_size else answer.get("nextPageToken"),
+    }
+    if include_summary:
+        projected["summary"] = answer.get("summary", "No summary available.")
+    return projected
+
+def build_response(request, payload: dict, status: int, headers: dict) -> Response:
+    """
+    Encodes and compresses a payload according to the request's Accept headers.
+    """
+    body, content_type = encode_payload(payload, request.headers.get('Accept', ''))
+    body, content_encoding = compress_body(body, request.headers.get('Accept-Encoding', ''))
+    
+    response_headers = {**headers, 'Vary': 'Accept, Accept-Encoding'}
+    if content_encoding:
+        response_headers['Content-Encoding'] = content_encoding
+    return Response(body, status=status, headers=response_headers, content_type=content_type)
+
+def get_request_identity(request) -> tuple:
+    """
+    Returns the rate limiting identity and quota tier for a request.
+    Uses the JWT user when a valid bearer token is sent, otherwise the client IP.
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer ') and JWT_SIGNING_KEY:
+        try:
+            claims = jwt.decode(auth_header[len('Bearer '):], JWT_SIGNING_KEY, algorithms=[JWT_ALGORITHM])
+            if claims.get("token_type") == "access" and claims.get("user_id") is not None:
+                profession = claims.get("profession")
+                tier = profession if profession in QUOTA_TIERS else "other"
+                return (f"user:{claims['user_id']}", tier)
+        except jwt.InvalidTokenError as e:
+            print(f"Ignoring invalid access token: {e}")
+    
+    # Each trusted proxy appends to any X-Forwarded-For the client sent, so the client IP
+    # is the entry TRUSTED_PROXY_HOPS from the end; earlier entries are client-controlled
+    forwarded_for = [entry.strip() for entry in request.headers.get('X-Forwarded-For', '').split(',') if entry.strip()]
+    if forwarded_for:
+        client_ip = forwarded_for[-min(TRUSTED_PROXY_HOPS, len(forwarded_for))]
+    else:
+        client_ip = request.remote_addr
+    return (f"ip:{client_ip}", "anonymous")
+
+def check_rate_limit(identity: str, tier: str):
+    """
+    Applies the token bucket and the per-window quota for an identity.
+    Returns None if the request is allowed, otherwise the seconds to wait before retrying.
+    """
+    limits = QUOTA_TIERS[tier]
+    now = time.time()
+    
+    with _rate_limit_lock:
+        if len(_request_windows) > MAX_TRACKED_IDENTITIES:
+            prune_rate_limit_state(now)
+        
+        # Token bucket smooths out bursts
+        tokens, last_refill = _token_buckets.get(identity, (limits["burst"], now))
+        tokens = min(limits["burst"], tokens + (now - last_refill) * limits["rate"])
+        if tokens < 1:
+            _token_buckets[identity] = (tokens, now)
+            return math.ceil((1 - tokens) / limits["rate"])
+        
+        # Sliding window enforces the tier quota on this instance
+        window = _request_windows.setdefault(identity, deque())
+        while window and window[0] <= now - QUOTA_WINDOW_SECONDS:
+            window.popleft()
+        if len(window) >= limits["quota"]:
+            _token_buckets[identity] = (tokens, now)
+            return math.ceil(window[0] + QUOTA_WINDOW_SECONDS - now)
+        
+        _token_buckets[identity] = (tokens - 1, now)
+        window.append(now)
+    
+    if USE_SHARED_RATE_LIMIT:
+        return check_shared_quota(identity, limits["quota"], now)
+    return None
+
+def prune_rate_limit_state(now: float):
+    """
+    Drops identities with no requests in the current window, then the least recently
+    seen ones until there is headroom again. Caller must hold the lock.
+    """
+    for identity in list(_request_windows):
+        window = _request_windows[identity]
+        if not window or window[-1] <= now - QUOTA_WINDOW_SECONDS:
+            del _request_windows[identity]
+            _token_buckets.pop(identity, None)
+    
+    excess = len(_request_windows) - int(MAX_TRACKED_IDENTITIES * PRUNE_TARGET_RATIO)
+    if excess > 0:
+        by_last_seen = sorted(_request_windows, key=lambda identity: _request_windows[identity][-1])
+        for identity in by_last_seen[:excess]:
+            del _request_windows[identity]
+            _token_buckets.pop(identity, None)
+
+def check_shared_quota(identity: str, quota: int, now: float):
+    """
+    Enforces the tier quota across all instances with a Firestore counter per window.
+    Fails open so an unavailable counter store never blocks searches.
+    """
+    window_start = int(now // QUOTA_WINDOW_SECONDS) * QUOTA_WINDOW_SECONDS
+    try:
+        counter_ref = get_firestore_client().collection(RATE_LIMIT_COLLECTION).document(f"{identity}_{window_start}")
+        counter_ref.set({
+            "identity": identity,
+            "count": firestore.Increment(1),
+            "window_start": window_start,
+            "expire_at": datetime.datetime.fromtimestamp(window_start + QUOTA_WINDOW_SECONDS, datetime.timezone.utc),
+        }, merge=True)
+        if counter_ref.get().to_dict().get("count", 0) > quota:
+            return math.ceil(window_start + QUOTA_WINDOW_SECONDS - now)
+    except Exception as e:
+        print(f"Could not check shared rate limit: {e}")
+    return None
+
+def encode_page_token(offset: int) -> str:
+    """
+    Encodes a result offset as an opaque page token for clients.
+    """
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode('utf-8')).decode('ascii')
+
+def decode_page_token(page_token: str):
+    """
+    Decodes a page token into a result offset. Returns None if the token is invalid.
+    """
+    if not page_token:
+        return 0
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(page_token.encode('ascii')))["offset"]
+        if isinstance(offset, bool) or not isinstance(offset, int) or not 0 <= offset <= MAX_RESULT_OFFSET:
+            return None
+        return offset
+    except Exception:
+        return None
+
+def parse_filter_date(value, field_name: str, end_of_day: bool = False) -> int:
+    """
+    Parses an ISO 8601 date or datetime into epoch seconds (UTC when no offset is given).
+    With end_of_day, a date without a time means the last second of that day.
+    """
+    value = str(value)
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'"{field_name}" must be an ISO 8601 date or datetime.')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    
+    is_date_only = 'T' not in value and ' ' not in value
+    if end_of_day and is_date_only:
+        parsed += datetime.timedelta(days=1, seconds=-1)
+    return int(parsed.timestamp())
+
+def build_search_filter(filters: dict) -> str:
+    """
+    Converts request filters into a Vertex AI Search filter expression.
+    Raises ValueError with a client-facing message for invalid filters.
+    """
+    unknown = set(filters) - set(FILTER_FIELDS) - {'uploadedAfter', 'uploadedBefore'}
+    if unknown:
+        raise ValueError(f'Unknown filters: {", ".join(sorted(unknown))}.')
+    
+    clauses = []
+    for filter_name, struct_field in FILTER_FIELDS.items():
+        values = filters.get(filter_name)
+        if values is None:
+            continue
+        if isinstance(values, str):
+            values = [values]
+        if (not isinstance(values, list) or not values or len(values) > MAX_FILTER_VALUES
+                or not all(isinstance(value, str) and value for value in values)):
+            raise ValueError(f'"{filter_name}" must be a non-empty string or a list of up to {MAX_FILTER_VALUES} strings.')
+        clauses.append(f'{struct_field}: ANY({", ".join(json.dumps(value, ensure_ascii=False) for value in values)})')
+    
+    if filters.get('uploadedAfter') is not None:
+        clauses.append(f"upload_time >= {parse_filter_date(filters['uploadedAfter'], 'uploadedAfter')}")
+    if filters.get('uploadedBefore') is not None:
+        # Inclusive: a date-only value keeps documents uploaded during that day
+        upload_before = parse_filter_date(filters['uploadedBefore'], 'uploadedBefore', end_of_day=True)
+        clauses.append(f"upload_time <= {upload_before}")
+    
+    return " AND ".join(clauses)
+
+def search_data_store(search_query: str, page_size: int = DEFAULT_PAGE_SIZE, offset: int = 0,
+                      fields: list = None, search_filter: str = "", include_summary: bool = True) -> dict:
+    """
+    Calls the Vertex AI Search API across all documents, or the subset matched by search_filter.
+    
+    The summary is only generated for the first page when include_summary is set,
+    and snippets are only requested when they are part of the projected fields.
+    """
+    fields = fields or REFERENCE_FIELDS
+    with_summary = include_summary and offset == 0
+    
     client_options = (
         ClientOptions(api_endpoint=f"{LOCATION}-discoveryengine.googleapis.com") 
         if LOCATION != "global" else None
@@ -78,49 +576,63 @@ def search_data_store(search_query: str) -> dict:
             model_prompt_spec=discoveryengine.SearchRequest.ContentSearchSpec.SummarySpec.ModelPromptSpec(
                 preamble="You are a legal AI assistant. Provide accurate, helpful responses based on the legal documents in the knowledge base."
             )
-        ),
+        ) if with_summary else None,
         snippet_spec=discoveryengine.SearchRequest.ContentSearchSpec.SnippetSpec(
             return_snippet=True,
             max_snippet_count=3
-        )
+        ) if "snippet" in fields else None
     )
     
-    print(f"Searching with query: {search_query}")
+    print(f"Searching with query: {search_query} (offset: {offset}, page size: {page_size}, filter: {search_filter or 'none'})")
     
     request = discoveryengine.SearchRequest(
         serving_config=serving_config,
         query=search_query,
-        page_size=10,  # Increased from 5 for more results
+        page_size=page_size,
+        offset=offset,
+        filter=search_filter,
         content_search_spec=content_search_spec,
     )
     
     response = client.search(request)
     
+    next_offset = offset + len(response.results)
+    
     # Enhanced response formatting
     formatted_response = {
-        "summary": response.summary.summary_text if response.summary else "No summary available.",
         "query": search_query,
-        "total_results": len(response.results),
-        "references": []
+        "total_results": response.total_size,
+        "references": [],
+        # Vertex page tokens require identical request parameters, so the
+        # cursor handed to clients carries the offset instead
+        "nextPageToken": (
+            encode_page_token(next_offset)
+            if response.next_page_token and next_offset <= MAX_RESULT_OFFSET else None
+        )
     }
+    if with_summary:
+        formatted_response["summary"] = response.summary.summary_text if response.summary else "No summary available."
     
     for result in response.results:
         doc_data = result.document.derived_struct_data
+        reference = {}
         
-        # Extract snippets more robustly
-        snippets = []
-        if "snippets" in doc_data and doc_data["snippets"]:
-            for snippet_data in doc_data["snippets"]:
-                if isinstance(snippet_data, dict) and "snippet" in snippet_data:
-                    snippets.append(snippet_data["snippet"])
-        
-        snippet_text = " ... ".join(snippets) if snippets else "No snippet available."
+        if "document_id" in fields:
+            reference["document_id"] = result.document.id if hasattr(result.document, 'id') else ""
+        if "title" in fields:
+            reference["title"] = doc_data.get("title", "Untitled Document")
+        if "link" in fields:
+            reference["link"] = doc_data.get("link", "")
+        if "snippet" in fields:
+            # Extract snippets more robustly
+            snippets = []
+            if "snippets" in doc_data and doc_data["snippets"]:
+                for snippet_data in doc_data["snippets"]:
+                    if isinstance(snippet_data, dict) and "snippet" in snippet_data:
+                        snippets.append(snippet_data["snippet"])
+            
+            reference["snippet"] = " ... ".join(snippets) if snippets else "No snippet available."
         
-        formatted_response["references"].append({
-            "title": doc_data.get("title", "Untitled Document"),
-            "link": doc_data.get("link", ""),
-            "snippet": snippet_text,
-            "document_id": result.document.id if hasattr(result.document, 'id') else ""
-        })
+        formatted_response["references"].append(reference)
     
     return formatted_response
\ No newline at end of file
@@ -0,0 +1,76 @@
+# Response encoding helpers for the Search Function
+import gzip
+import json
+
+# Faster encoders are optional so the function still works with the standard library alone
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# --- CONFIGURATION ---
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPES = ["application/msgpack", "application/x-msgpack"]
+MIN_COMPRESS_BYTES = 1024  # Smaller bodies are not worth compressing
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Favours encode speed over the last few bytes
+# --- END CONFIGURATION ---
+
+def encode_json(payload: dict) -> bytes:
+    """
+    Encodes a payload as JSON, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def encode_payload(payload: dict, accept: str = "") -> tuple:
+    """
+    Encodes a payload in the format requested by the Accept header.
+    Returns the body and its content type. MessagePack is only used when asked for.
+    """
+    accept = (accept or "").lower()
+    if msgpack is not None:
+        for content_type in MSGPACK_CONTENT_TYPES:
+            if content_type in accept:
+                return (msgpack.packb(payload, use_bin_type=True), content_type)
+    return (encode_json(payload), JSON_CONTENT_TYPE)
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """
+    Returns the content codings a client accepts, ignoring those with q=0.
+    """
+    encodings = set()
+    for part in (accept_encoding or "").lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        if not coding:
+            continue
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(coding.strip())
+    return encodings
+
+def compress_body(body: bytes, accept_encoding: str = "") -> tuple:
+    """
+    Compresses a body with the best coding the client accepts.
+    Returns the body and its Content-Encoding, or None if it was left uncompressed.
+    """
+    if len(body) < MIN_COMPRESS_BYTES:
+        return (body, None)
+
+    encodings = accepted_encodings(accept_encoding)
+    if brotli is not None and 'br' in encodings:
+        return (brotli.compress(body, quality=BROTLI_QUALITY), 'br')
+    if 'gzip' in encodings or '*' in encodings:
+        return (gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip')
+    return (body, None)
@@ -99,4 +99,6 @@ def login(request, data: LoginSchema):
         return api.create_response(request, {"error": "Please verify your email first"}, status=403)
 
     refresh = RefreshToken.for_user(user)
+    # Used by the search function to pick the user's rate limit tier
+    refresh["profession"] = user.profession
     return {"access": str(refresh.access_token), "refresh": str(refresh)}
@@ -1,15 +1,35 @@
 import functions_framework
 import datetime
+import os
 import re
 import uuid
+import jwt
+from google.cloud import firestore
 from google.cloud import storage
 
 # --- CONFIGURATION ---
+PROJECT_ID = "eminent-cycle-472512-u1"
 BUCKET_NAME = "spastha-final-bucket"
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 MB in bytes
 ALLOWED_EXTENSIONS = ['.pdf']
+DOCUMENT_TYPES = ['legal_document', 'judgment', 'statute', 'contract', 'petition', 'notice']
+JWT_SIGNING_KEY = os.environ.get('JWT_SIGNING_KEY', '')  # Must match the Django SECRET_KEY
+JWT_ALGORITHM = "HS256"
+INGESTION_STATUS_COLLECTION = "ingestion_status"  # Shared with the ingest function
+STATE_AWAITING_UPLOAD = "awaiting_upload"  # First state of the ingest function's lifecycle
 # --- END CONFIGURATION ---
 
+_firestore_client = None
+
+def get_firestore_client():
+    """
+    Returns a Firestore client, reused across invocations of the same instance.
+    """
+    global _firestore_client
+    if _firestore_client is None:
+        _firestore_client = firestore.Client(project=PROJECT_ID)
+    return _firestore_client
+
 @functions_framework.http
 def generate_signed_url_v4(request):
     """
@@ -20,7 +40,7 @@ def generate_signed_url_v4(request):
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST, OPTIONS',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
@@ -58,6 +78,17 @@ def generate_signed_url_v4(request):
         if not sanitized_filename:
             return ({'error': 'Invalid filename provided.'}, 400, headers)
         
+        # Optional metadata recorded on the object so searches can be filtered on it
+        document_type = request_json.get('documentType', '')
+        if document_type and document_type not in DOCUMENT_TYPES:
+            return ({'error': f'"documentType" must be one of: {", ".join(DOCUMENT_TYPES)}.'}, 400, headers)
+        
+        case_id = str(request_json.get('caseId', '')).strip()
+        if case_id and not re.fullmatch(r'[\w\-/.]{1,64}', case_id, re.ASCII):
+            return ({'error': 'Invalid "caseId" provided.'}, 400, headers)
+        
+        uploaded_by = get_uploader_id(request)
+        
         # Add timestamp and UUID to prevent filename conflicts
         timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
         unique_id = str(uuid.uuid4())[:8]
@@ -73,6 +104,16 @@ def generate_signed_url_v4(request):
             ['content-length-range', 1, MAX_FILE_SIZE],  # File size constraints
         ]
         
+        # x-goog-meta-* headers become object metadata read by the ingest function.
+        # Only non-empty values are signed, so uploads without metadata need no extra headers.
+        upload_headers = {'x-goog-content-length-range': f'1,{MAX_FILE_SIZE}'}
+        metadata_headers = {
+            'x-goog-meta-document-type': document_type,
+            'x-goog-meta-uploaded-by': uploaded_by,
+            'x-goog-meta-case-id': case_id,
+        }
+        upload_headers.update({name: value for name, value in metadata_headers.items() if value})
+        
         function_service_account_email = "992685094776-compute@developer.gserviceaccount.com"
         # Generate a signed URL that is valid for 15 minutes    
         url = blob.generate_signed_url(
@@ -82,9 +123,7 @@ def generate_signed_url_v4(request):
             content_type="application/pdf",  # Enforce PDF uploads
             service_account_email=function_service_account_email,
             
-            headers={
-                'x-goog-content-length-range': f'1,{MAX_FILE_SIZE}'
-            }
+            headers=upload_headers
         )
         
         response_data = {
@@ -93,9 +132,12 @@ def generate_signed_url_v4(request):
             'originalFileName': file_name,
             'expiresAt': (datetime.datetime.now() + datetime.timedelta(minutes=15)).isoformat(),
             'maxFileSize': MAX_FILE_SIZE,
-            'allowedTypes': ALLOWED_EXTENSIONS
+            'allowedTypes': ALLOWED_EXTENSIONS,
+            'uploadHeaders': upload_headers  # Must be sent with the PUT request
         }
         
+        record_pending_upload(final_filename, uploaded_by)
+        
         print(f"Generated signed URL for file: {final_filename}")
         return (response_data, 200, headers)
         
@@ -103,6 +145,36 @@ def generate_signed_url_v4(request):
         print(f"An error occurred generating signed URL: {e}")
         return ({'error': 'An internal error occurred while generating the upload URL.'}, 500, headers)
 
+def record_pending_upload(file_name: str, uploaded_by: str):
+    """
+    Creates the ingestion status entry so clients can poll it straight after uploading.
+    Failures never block URL generation.
+    """
+    try:
+        get_firestore_client().collection(INGESTION_STATUS_COLLECTION).document(file_name).set({
+            "state": STATE_AWAITING_UPLOAD,
+            "uploaded_by": uploaded_by,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        })
+    except Exception as e:
+        print(f"Could not record ingestion status for {file_name}: {e}")
+
+def get_uploader_id(request) -> str:
+    """
+    Returns the user ID from the request's access token, or an empty string for anonymous uploads.
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer ') or not JWT_SIGNING_KEY:
+        return ''
+    try:
+        claims = jwt.decode(auth_header[len('Bearer '):], JWT_SIGNING_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError as e:
+        print(f"Ignoring invalid access token: {e}")
+        return ''
+    if claims.get("token_type") != "access":
+        return ''
+    return str(claims.get("user_id", ''))
+
 def sanitize_filename(filename: str) -> str:
     """
     Sanitize filename to prevent security issues and ensure valid characters.
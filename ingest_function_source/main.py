@@ -1,16 +1,61 @@
 # FUNCTION 1: Document Ingestion
 import functions_framework
+import datetime
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import NotFound
+import jwt
 from google.cloud import discoveryengine_v1 as discoveryengine
+from google.cloud import firestore
+from google.cloud import storage
 from google.api_core.client_options import ClientOptions
 
 # --- FINAL CONFIGURATION ---
 PROJECT_ID = "eminent-cycle-472512-u1"
 LOCATION = "global"
 DATA_STORE_ID = "spastha-final-datastore_1758347694410"  # Replace with your actual data store ID
+
+# Answer store metadata shared with the search function
+CORPUS_META_COLLECTION = "answer_store_meta"
+CORPUS_META_DOCUMENT = "corpus"
+
+# Ingestion status store, keyed by the fileName returned from generate_signed_url_v4
+INGESTION_STATUS_COLLECTION = "ingestion_status"
+STATE_AWAITING_UPLOAD = "awaiting_upload"  # Written by generate_signed_url_v4
+STATE_UPLOADED = "uploaded"
+STATE_INDEXING = "indexing"
+STATE_SEARCHABLE = "searchable"
+STATE_FAILED = "failed"
+POLL_PAGE_SIZE = 100  # Status entries read per page while polling
+POLL_CONCURRENCY = 10  # Operations checked in parallel
+MAX_INDEXING_SECONDS = 6 * 3600  # Documents still indexing after this long are marked failed
+INDEXING_FAILED_MESSAGE = "The document could not be indexed."  # Details are only logged
+JWT_SIGNING_KEY = os.environ.get('JWT_SIGNING_KEY', '')  # Must match the Django SECRET_KEY
+JWT_ALGORITHM = "HS256"
 # --- END CONFIGURATION ---
 
+_firestore_client = None
+
+def get_firestore_client():
+    """
+    Returns a Firestore client, reused across invocations of the same instance.
+    """
+    global _firestore_client
+    if _firestore_client is None:
+        _firestore_client = firestore.Client(project=PROJECT_ID)
+    return _firestore_client
+
+def get_document_client():
+    """
+    Returns a Vertex AI Search document client for the configured location.
+    """
+    client_options = (
+        ClientOptions(api_endpoint=f"{LOCATION}-discoveryengine.googleapis.com") 
+        if LOCATION != "global" else None
+    )
+    return discoveryengine.DocumentServiceClient(client_options=client_options)
+
 @functions_framework.cloud_event
 def ingest_document(cloud_event):
     """
@@ -27,23 +72,224 @@ def ingest_document(cloud_event):
             return
             
         print(f"Processing document: {file_name}")
+        set_ingestion_status(file_name, STATE_UPLOADED, document_id=get_document_id(file_name))
+        
         document_uri = f"gs://{bucket_name}/{file_name}"
-        index_document(document_uri, file_name)
-        print(f"Successfully indexed document {file_name}")
+        try:
+            operation = index_document(
+                document_uri,
+                file_name,
+                metadata=data.get('metadata') or {},
+                time_created=data.get('timeCreated', '')
+            )
+        except Exception:
+            set_ingestion_status(file_name, STATE_FAILED, error=INDEXING_FAILED_MESSAGE)
+            raise
+        
+        # poll_ingestion_operations marks the document searchable once the operation completes
+        set_ingestion_status(file_name, STATE_INDEXING, operation_name=operation.operation.name)
+        print(f"Indexing started for document {file_name}")
         
     except Exception as e:
         print(f"Error processing document ingestion: {e}")
         raise e
 
-def index_document(document_uri: str, file_name: str):
+@functions_framework.http
+def poll_ingestion_operations(request):
     """
-    Indexes a document in Vertex AI Search.
+    HTTP Cloud Function (invoked by Cloud Scheduler) that checks the indexing
+    operations of all documents still being indexed, oldest first and several
+    at a time, so clients only ever read the status store instead of polling
+    Vertex AI Search.
     """
-    client_options = (
-        ClientOptions(api_endpoint=f"{LOCATION}-discoveryengine.googleapis.com") 
-        if LOCATION != "global" else None
-    )
-    client = discoveryengine.DocumentServiceClient(client_options=client_options)
+    try:
+        db = get_firestore_client()
+        client = get_document_client()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        searchable, failed, pending = 0, 0, 0
+        
+        with ThreadPoolExecutor(max_workers=POLL_CONCURRENCY) as executor:
+            last_snapshot = None
+            while True:
+                # Needs a composite index on (state, updated_at)
+                query = (
+                    db.collection(INGESTION_STATUS_COLLECTION)
+                    .where(filter=firestore.FieldFilter("state", "==", STATE_INDEXING))
+                    .order_by("updated_at")
+                    .limit(POLL_PAGE_SIZE)
+                )
+                if last_snapshot is not None:
+                    query = query.start_after(last_snapshot)
+                page = list(query.stream())
+                if not page:
+                    break
+                last_snapshot = page[-1]
+                
+                outcomes = executor.map(lambda snapshot: get_indexing_outcome(client, snapshot, now), page)
+                for snapshot, (state, error) in zip(page, outcomes):
+                    if state == STATE_SEARCHABLE:
+                        set_ingestion_status(snapshot.id, STATE_SEARCHABLE)
+                        searchable += 1
+                    elif state == STATE_FAILED:
+                        set_ingestion_status(snapshot.id, STATE_FAILED, error=error)
+                        failed += 1
+                    else:
+                        pending += 1
+        
+        # New documents change search results, so stored answers must be refreshed
+        if searchable:
+            invalidate_answer_store()
+        
+        print(f"Ingestion polling complete. Searchable: {searchable}, failed: {failed}, pending: {pending}")
+        return ({'searchable': searchable, 'failed': failed, 'pending': pending}, 200)
+        
+    except Exception as e:
+        print(f"An error occurred while polling ingestion operations: {e}")
+        return ({'error': 'An internal error occurred while polling ingestion operations.'}, 500)
+
+@functions_framework.http
+def get_ingestion_status(request):
+    """
+    HTTP Cloud Function that returns the ingestion state of an uploaded document.
+    States move from awaiting_upload to uploaded, indexing, then searchable or failed.
+    Uploads made by a signed-in user are only visible with that user's access token.
+    Clients can also subscribe to ingestion_status/{fileName} with a Firestore listener.
+    """
+    # Handle CORS preflight requests
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+    
+    headers = {'Access-Control-Allow-Origin': '*'}
+    
+    try:
+        if request.method != 'POST':
+            return ({'error': 'Only POST method is allowed.'}, 405, headers)
+        
+        request_json = request.get_json(silent=True)
+        if not request_json:
+            return ({'error': 'Request must contain valid JSON.'}, 400, headers)
+        
+        file_name = str(request_json.get('fileName', '')).strip()
+        if not file_name or '/' in file_name:
+            return ({'error': 'JSON body must contain a valid "fileName" field.'}, 400, headers)
+        
+        snapshot = get_firestore_client().collection(INGESTION_STATUS_COLLECTION).document(file_name).get()
+        status = snapshot.to_dict() if snapshot.exists else None
+        
+        # Someone else's upload gets the same answer as a missing one, so fileNames cannot be probed
+        if status is None or (status.get("uploaded_by") and status["uploaded_by"] != get_requester_id(request)):
+            return ({'error': 'No upload found for this fileName.'}, 404, headers)
+        
+        updated_at = status.get("updated_at")
+        return ({
+            'fileName': file_name,
+            'state': status.get("state"),
+            'documentId': status.get("document_id"),
+            'error': status.get("error"),
+            'updatedAt': updated_at.isoformat() if updated_at else None,
+        }, 200, headers)
+        
+    except Exception as e:
+        print(f"An error occurred while reading ingestion status: {e}")
+        return ({'error': 'An internal error occurred while reading the ingestion status.'}, 500, headers)
+
+@functions_framework.http
+def backfill_document_metadata(request):
+    """
+    HTTP Cloud Function (run once after deploying metadata filters) that adds the
+    document_id and upload_time fields to documents indexed before they existed,
+    so that document and date filters also match older documents.
+    """
+    try:
+        client = get_document_client()
+        storage_client = storage.Client()
+        parent = client.branch_path(
+            project=PROJECT_ID,
+            location=LOCATION,
+            data_store=DATA_STORE_ID,
+            branch="default_branch"
+        )
+        
+        updated, skipped, failed = 0, 0, 0
+        for document in client.list_documents(parent=parent):
+            struct_data = dict(document.struct_data)
+            if "document_id" in struct_data and "upload_time" in struct_data:
+                skipped += 1
+                continue
+            
+            try:
+                struct_data["document_id"] = document.id
+                if "upload_time" not in struct_data:
+                    upload_time = get_object_creation_time(storage_client, document.content.uri)
+                    struct_data["upload_timestamp"] = upload_time.isoformat()
+                    struct_data["upload_time"] = int(upload_time.timestamp())
+                
+                document.struct_data = struct_data
+                client.update_document(request=discoveryengine.UpdateDocumentRequest(document=document))
+                updated += 1
+            except Exception as e:
+                print(f"Failed to backfill metadata for document {document.id}: {e}")
+                failed += 1
+        
+        print(f"Metadata backfill complete. Updated: {updated}, up to date: {skipped}, failed: {failed}")
+        return ({'updated': updated, 'upToDate': skipped, 'failed': failed}, 200)
+        
+    except Exception as e:
+        print(f"An error occurred while backfilling document metadata: {e}")
+        return ({'error': 'An internal error occurred while backfilling document metadata.'}, 500)
+
+def get_object_creation_time(storage_client, document_uri: str) -> datetime.datetime:
+    """
+    Returns when the Cloud Storage object behind a document was created.
+    """
+    bucket_name, _, object_name = document_uri[len("gs://"):].partition('/')
+    blob = storage_client.bucket(bucket_name).get_blob(object_name)
+    if blob is None or blob.time_created is None:
+        raise ValueError(f"Object not found: {document_uri}")
+    return blob.time_created
+
+def get_requester_id(request) -> str:
+    """
+    Returns the user ID from the request's access token, or an empty string if there is none.
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer ') or not JWT_SIGNING_KEY:
+        return ''
+    try:
+        claims = jwt.decode(auth_header[len('Bearer '):], JWT_SIGNING_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError as e:
+        print(f"Ignoring invalid access token: {e}")
+        return ''
+    if claims.get("token_type") != "access":
+        return ''
+    return str(claims.get("user_id", ''))
+
+def get_document_id(file_name: str) -> str:
+    """
+    Returns the Vertex AI Search document ID for an uploaded file.
+    """
+    # More robust document ID sanitization
+    sanitized_file_name = re.sub(r'[^a-zA-Z0-9_-]', '-', file_name.lower())
+    # Ensure ID doesn't start with a number and isn't too long
+    if sanitized_file_name[0].isdigit():
+        sanitized_file_name = 'doc-' + sanitized_file_name
+    return sanitized_file_name[:100]  # Limit length
+
+def index_document(document_uri: str, file_name: str, metadata: dict = None, time_created: str = ''):
+    """
+    Starts indexing a document in Vertex AI Search and returns the long-running operation.
+    
+    Uploader and case details come from the object metadata set through the
+    signed upload URL, so that searches can be filtered on them.
+    """
+    metadata = metadata or {}
+    client = get_document_client()
     
     parent = client.branch_path(
         project=PROJECT_ID,
@@ -52,19 +298,19 @@ def index_document(document_uri: str, file_name: str):
         branch="default_branch"
     )
     
-    # More robust document ID sanitization
-    sanitized_file_name = re.sub(r'[^a-zA-Z0-9_-]', '-', file_name.lower())
-    # Ensure ID doesn't start with a number and isn't too long
-    if sanitized_file_name[0].isdigit():
-        sanitized_file_name = 'doc-' + sanitized_file_name
-    sanitized_file_name = sanitized_file_name[:100]  # Limit length
+    sanitized_file_name = get_document_id(file_name)
+    upload_time = parse_upload_time(time_created)
     
     document = discoveryengine.Document(
         id=sanitized_file_name,
         struct_data={
             "title": file_name,
-            "document_type": "legal_document",
-            "upload_timestamp": str(os.environ.get('TIMESTAMP', '')),
+            "document_id": sanitized_file_name,
+            "document_type": metadata.get('document-type') or "legal_document",
+            "upload_timestamp": upload_time.isoformat(),
+            "upload_time": int(upload_time.timestamp()),  # Numeric copy for range filters
+            "uploaded_by": metadata.get('uploaded-by', ''),
+            "case_id": metadata.get('case-id', ''),
         },
         content=discoveryengine.Document.Content(
             uri=document_uri,
@@ -72,12 +318,86 @@ def index_document(document_uri: str, file_name: str):
         )
     )
     
-    request = discoveryengine.CreateDocumentRequest(
+    # Imported (rather than created) so indexing has an operation that can be polled
+    request = discoveryengine.ImportDocumentsRequest(
         parent=parent,
-        document=document,
-        document_id=document.id
+        inline_source=discoveryengine.ImportDocumentsRequest.InlineSource(documents=[document]),
+        reconciliation_mode=discoveryengine.ImportDocumentsRequest.ReconciliationMode.INCREMENTAL
     )
     
-    operation = client.create_document(request=request)
-    print(f"Document indexing initiated. Operation: {operation.name}")
-    return operation
\ No newline at end of file
+    operation = client.import_documents(request=request)
+    print(f"Document indexing initiated. Operation: {operation.operation.name}")
+    return operation
+
+def parse_upload_time(time_created: str) -> datetime.datetime:
+    """
+    Parses the object's RFC 3339 creation time, falling back to the current time.
+    """
+    try:
+        return datetime.datetime.fromisoformat(time_created.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+def get_indexing_outcome(client, status_snapshot, now: datetime.datetime) -> tuple:
+    """
+    Returns the new (state, error) of a document that is being indexed.
+    Operations that no longer exist, or that run past MAX_INDEXING_SECONDS, count as failed.
+    """
+    status = status_snapshot.to_dict()
+    operation_name = status.get("operation_name")
+    
+    if operation_name:
+        try:
+            operation = client.get_operation({"name": operation_name})
+            if operation.done:
+                error = get_operation_error(operation)
+                if not error:
+                    return (STATE_SEARCHABLE, "")
+                print(f"Indexing failed for {status_snapshot.id}: {error}")
+                return (STATE_FAILED, INDEXING_FAILED_MESSAGE)
+        except NotFound:
+            return (STATE_FAILED, "Indexing operation no longer exists")
+        except Exception as e:
+            print(f"Could not check operation {operation_name}: {e}")
+    
+    updated_at = status.get("updated_at")
+    if updated_at is not None and (now - updated_at).total_seconds() > MAX_INDEXING_SECONDS:
+        return (STATE_FAILED, "Indexing did not complete in time")
+    return (STATE_INDEXING, "")
+
+def get_operation_error(operation) -> str:
+    """
+    Returns the error message of a finished import operation, or an empty string if it succeeded.
+    """
+    if operation.HasField("error") and operation.error.code != 0:
+        return operation.error.message or f"Operation failed with code {operation.error.code}"
+    
+    response = discoveryengine.ImportDocumentsResponse.deserialize(operation.response.value)
+    if response.error_samples:
+        return response.error_samples[0].message or "Document could not be imported"
+    return ""
+
+def set_ingestion_status(file_name: str, state: str, **fields):
+    """
+    Records the ingestion state of a document. Failures never block ingestion.
+    """
+    try:
+        get_firestore_client().collection(INGESTION_STATUS_COLLECTION).document(file_name).set({
+            **fields,
+            "state": state,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    except Exception as e:
+        print(f"Could not record ingestion status for {file_name}: {e}")
+
+def invalidate_answer_store():
+    """
+    Bumps the corpus version so stored answers are refreshed on the next warming run.
+    """
+    try:
+        get_firestore_client().collection(CORPUS_META_COLLECTION).document(CORPUS_META_DOCUMENT).set({
+            "version": firestore.Increment(1),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+    except Exception as e:
+        print(f"Could not invalidate answer store: {e}")
\ No newline at end of file